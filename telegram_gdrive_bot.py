@@ -1,27 +1,42 @@
+import asyncio
+import contextlib
+import hashlib
+import html
+import json
 import logging
 import os
-import json
-from pathlib import Path
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import aiohttp
+import google_auth_httplib2
 from dotenv import load_dotenv
 
 # Google Drive API related imports
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload, build_http
 
 # Telegram Bot related imports
-from telegram import Update, InputFile
+from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 
 # --- Configuration ---
 load_dotenv()  # Load variables from .env file
@@ -33,12 +48,32 @@ try:
 except ValueError:
     MAX_FILE_SIZE_MB = 100 # Default if invalid value in .env
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+try:
+    DAILY_QUOTA_MB = int(os.getenv("DAILY_QUOTA_MB", 0)) # Per-user upload volume per 24 hours, 0 = unlimited
+except ValueError:
+    DAILY_QUOTA_MB = 0 # Default if invalid value in .env
+DAILY_QUOTA_BYTES = DAILY_QUOTA_MB * 1024 * 1024
+# Optional self-hosted Bot API server (https://github.com/tdlib/telegram-bot-api) started with --local.
+# Lifts the cloud Bot API's 20 MB download cap (up to 2 GB) and lets the bot read files straight from disk.
+TELEGRAM_LOCAL_API_URL = os.getenv("TELEGRAM_LOCAL_API_URL", None) # e.g. http://localhost:8081
 
 # Google API Scopes - If modifying these scopes, delete the token.json file.
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
 CREDENTIALS_FILE = "credentials.json" # Downloaded from Google Cloud Console
 TOKEN_FILE = "token.json"             # Stores user's access and refresh tokens
-UPLOADED_FILES_DB = "uploaded_files.json" # Simple JSON DB to store file info
+UPLOADED_FILES_DB = "uploaded_files.db"  # SQLite DB to store file info
+LEGACY_UPLOADED_FILES_JSON = "uploaded_files.json"  # Old JSON DB, imported into SQLite once on startup
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)  # Refresh the token in the background this long before expiry
+
+# Transfer tuning
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024      # Read size when streaming from Telegram
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024    # Resumable upload chunk size for Google Drive
+SPOOL_MAX_SIZE = 16 * 1024 * 1024      # Files up to this size stay in memory, larger ones spill to a temp file
+SINGLE_REQUEST_UPLOAD_MAX = 16 * 1024 * 1024  # Smaller files go up in one multipart request instead of a resumable session
+MAX_CONCURRENT_TRANSFERS = 4           # Files downloaded/uploaded at once (each holds up to SPOOL_MAX_SIZE in memory)
+PROGRESS_LOG_STEP = 20                 # Log upload progress every N percent
+
+FILES_PAGE_SIZE = 10  # Files per /myfiles page
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -48,14 +83,44 @@ logging.getLogger("httpx").setLevel(logging.WARNING) # Reduce verbosity from htt
 logger = logging.getLogger(__name__)
 
 # --- Google Drive Authentication ---
-def get_drive_service():
-    """Authenticates with Google Drive API and returns the service object."""
+# The Drive service (and the credentials behind it) is built once and reused
+# across uploads; it is only rebuilt when missing or its credentials go stale.
+_drive_service = None
+_drive_creds = None
+_saved_token = None  # Access token currently persisted in TOKEN_FILE
+_drive_service_lock = None  # Created in post_init, on the loop that runs the bot
+
+def _save_credentials(creds):
+    """Writes credentials to TOKEN_FILE, skipping the write if the token is unchanged."""
+    global _saved_token
+    if creds.token == _saved_token:
+        return
+    try:
+        with open(TOKEN_FILE, "w") as token:
+            token.write(creds.to_json())
+        _saved_token = creds.token
+        logger.info(f"Credentials saved to {TOKEN_FILE}")
+    except Exception as e:
+         logger.error(f"Error saving credentials to {TOKEN_FILE}: {e}")
+
+def _credentials_fresh(creds, margin: timedelta) -> bool:
+    """Returns True if the credentials are valid for at least `margin` longer."""
+    if not creds or not creds.valid:
+        return False
+    if creds.expiry and creds.expiry - datetime.utcnow() < margin:
+        return False
+    return True
+
+def _build_service():
+    """Authenticates with Google Drive API and returns a new service object."""
+    global _drive_creds, _saved_token
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first time.
     if os.path.exists(TOKEN_FILE):
         try:
             creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+            _saved_token = creds.token
         except Exception as e:
             logger.error(f"Error loading credentials from {TOKEN_FILE}: {e}")
             creds = None # Force re-authentication
@@ -89,17 +154,14 @@ def get_drive_service():
 
         # Save the credentials for the next run
         if creds:
-            try:
-                with open(TOKEN_FILE, "w") as token:
-                    token.write(creds.to_json())
-                logger.info(f"Credentials saved to {TOKEN_FILE}")
-            except Exception as e:
-                 logger.error(f"Error saving credentials to {TOKEN_FILE}: {e}")
-
+            _save_credentials(creds)
 
     # Build the Drive v3 service
     try:
-        service = build("drive", "v3", credentials=creds)
+        # Use the discovery document bundled with google-api-python-client (>= 2.0)
+        # instead of fetching it from Google every time the service is built.
+        service = build("drive", "v3", credentials=creds, static_discovery=True, cache_discovery=False)
+        _drive_creds = creds
         logger.info("Google Drive service created successfully.")
         return service
     except HttpError as error:
@@ -109,29 +171,305 @@ def get_drive_service():
         logger.error(f"An unexpected error occurred building the Drive service: {e}")
         return None
 
-# --- Persistence Functions (Simple JSON DB) ---
-def load_uploaded_files() -> list:
-    """Loads the list of uploaded files from the JSON database."""
+def get_drive_service():
+    """Builds the Drive service and caches it for subsequent uploads."""
+    global _drive_service
+    _drive_service = _build_service()
+    return _drive_service
+
+async def get_drive_service_cached():
+    """Returns the cached Drive service, building it only if there is none yet."""
+    # Token refreshes happen in the background (_refresh_job) or transparently inside
+    # the HTTP client, so the common path does no auth work at all.
+    if _drive_service is not None:
+        return _drive_service
+
+    async with _drive_service_lock:
+        # Another upload may have built it while we waited for the lock
+        if _drive_service is None:
+            await asyncio.to_thread(get_drive_service)
+        return _drive_service
+
+def invalidate_drive_service():
+    """Drops the cached Drive service so the next call to get_drive_service_cached rebuilds it."""
+    global _drive_service
+    _drive_service = None
+
+async def _refresh_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Refreshes the Google token ahead of expiry so uploads never wait on it."""
+    if not _drive_creds or not _drive_creds.refresh_token:
+        return
+    if _credentials_fresh(_drive_creds, TOKEN_REFRESH_MARGIN):
+        return
+
+    # Shares the lock with get_drive_service_cached so only one refresh runs at a time
+    async with _drive_service_lock:
+        creds = _drive_creds
+        if not creds or _credentials_fresh(creds, TOKEN_REFRESH_MARGIN):
+            return
+        try:
+            await asyncio.to_thread(creds.refresh, Request())
+            _save_credentials(creds)
+            logger.info("Google API token refreshed in the background.")
+        except Exception as e:
+            logger.error(f"Background token refresh failed: {e}")
+
+# --- Persistence Functions (SQLite DB) ---
+# One shared connection; WAL lets /myfiles read while an upload is being recorded.
+_conn = sqlite3.connect(UPLOADED_FILES_DB, check_same_thread=False)
+_conn.row_factory = sqlite3.Row
+_conn.execute("PRAGMA journal_mode=WAL")
+_conn.execute("PRAGMA synchronous=NORMAL")
+with _conn:
+    _conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS uploads (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            drive_id TEXT,
+            link TEXT,
+            user_id INTEGER,
+            ts INTEGER,
+            sha256 TEXT,
+            tg_unique_id TEXT,
+            size INTEGER
+        )
+        """
+    )
+
+def _ensure_column(name: str, decl: str):
+    """Adds a column to the uploads table if a database from an older version lacks it."""
+    columns = {row["name"] for row in _conn.execute("PRAGMA table_info(uploads)")}
+    if name not in columns:
+        _conn.execute(f"ALTER TABLE uploads ADD COLUMN {name} {decl}")
+
+with _conn:
+    _ensure_column("sha256", "TEXT")
+    _ensure_column("tg_unique_id", "TEXT")
+    _ensure_column("size", "INTEGER")
+    _conn.execute("CREATE INDEX IF NOT EXISTS ix_uploads_user ON uploads(user_id, id DESC)")
+    _conn.execute("CREATE INDEX IF NOT EXISTS ix_uploads_sha256 ON uploads(sha256)")
+    # One row per (user, Telegram file): the same file can appear in several users' lists
+    _conn.execute("DROP INDEX IF EXISTS ux_uploads_tg_unique_id")
+    _conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_uploads_user_tg_unique_id ON uploads(user_id, tg_unique_id)")
+
+def _migrate_legacy_json():
+    """Imports records from the old JSON DB, then renames it so this only happens once."""
+    if not os.path.exists(LEGACY_UPLOADED_FILES_JSON):
+        return
     try:
-        if os.path.exists(UPLOADED_FILES_DB):
-            with open(UPLOADED_FILES_DB, 'r') as f:
-                return json.load(f)
-        else:
-            return []
-    except json.JSONDecodeError:
-        logger.error(f"Error decoding {UPLOADED_FILES_DB}. Returning empty list.")
-        return []
+        with open(LEGACY_UPLOADED_FILES_JSON, 'r') as f:
+            legacy_files = json.load(f)
+        with _conn:
+            _conn.executemany(
+                "INSERT INTO uploads (name, drive_id, link, user_id) VALUES (?, ?, ?, ?)",
+                [
+                    (item.get("name"), item.get("id"), item.get("link"), item.get("telegram_user_id"))
+                    for item in legacy_files
+                ],
+            )
+        os.replace(LEGACY_UPLOADED_FILES_JSON, LEGACY_UPLOADED_FILES_JSON + ".migrated")
+        logger.info(f"Imported {len(legacy_files)} records from {LEGACY_UPLOADED_FILES_JSON} into {UPLOADED_FILES_DB}")
+    except (json.JSONDecodeError, AttributeError, TypeError) as e:
+        logger.error(f"Error decoding {LEGACY_UPLOADED_FILES_JSON}, not imported: {e}")
     except Exception as e:
-        logger.error(f"Error loading {UPLOADED_FILES_DB}: {e}")
+        logger.error(f"Error importing {LEGACY_UPLOADED_FILES_JSON}: {e}")
+
+_migrate_legacy_json()
+
+def list_recent(limit: int = 25, user_id: int = None, offset: int = 0) -> list:
+    """Returns recent uploads (newest first), optionally for a single user, skipping `offset` rows."""
+    try:
+        if user_id is None:
+            rows = _conn.execute(
+                "SELECT name, drive_id, link, user_id, ts FROM uploads ORDER BY id DESC LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+        else:
+            rows = _conn.execute(
+                "SELECT name, drive_id, link, user_id, ts FROM uploads WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (user_id, limit, offset),
+            ).fetchall()
+        return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        logger.error(f"Error reading from {UPLOADED_FILES_DB}: {e}")
         return []
 
-def save_uploaded_files(files_list: list):
-    """Saves the list of uploaded files to the JSON database."""
+def find_upload_by_sha256(sha256: str):
+    """Returns a previous upload with the same content hash, or None."""
     try:
-        with open(UPLOADED_FILES_DB, 'w') as f:
-            json.dump(files_list, f, indent=4)
-    except Exception as e:
-        logger.error(f"Error saving {UPLOADED_FILES_DB}: {e}")
+        row = _conn.execute(
+            "SELECT name, drive_id, link, sha256 FROM uploads WHERE sha256 = ? LIMIT 1", (sha256,)
+        ).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Error reading from {UPLOADED_FILES_DB}: {e}")
+        return None
+
+def find_upload_by_tg_unique_id(tg_unique_id: str, user_id: int = None):
+    """Returns a previous upload of the same Telegram file (by file_unique_id), or None.
+
+    If user_id is given, only that user's uploads are considered.
+    """
+    try:
+        if user_id is None:
+            row = _conn.execute(
+                "SELECT name, drive_id, link, sha256 FROM uploads WHERE tg_unique_id = ? LIMIT 1", (tg_unique_id,)
+            ).fetchone()
+        else:
+            row = _conn.execute(
+                "SELECT name, drive_id, link, sha256 FROM uploads WHERE tg_unique_id = ? AND user_id = ? LIMIT 1",
+                (tg_unique_id, user_id),
+            ).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Error reading from {UPLOADED_FILES_DB}: {e}")
+        return None
+
+def bytes_uploaded_since(user_id: int, since_ts: int) -> int:
+    """Returns how many bytes a user has uploaded since the given Unix timestamp."""
+    try:
+        return _conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM uploads WHERE user_id = ? AND ts > ?", (user_id, since_ts)
+        ).fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Error reading from {UPLOADED_FILES_DB}: {e}")
+        return 0
+
+def add_upload(
+    name: str, drive_id: str, link: str, user_id: int,
+    sha256: str = None, tg_unique_id: str = None, size: int = None,
+):
+    """Records a single uploaded file in the database.
+
+    Returns False if the user already has a row for this Telegram file (or the write failed).
+    """
+    try:
+        with _conn:
+            cursor = _conn.execute(
+                "INSERT INTO uploads (name, drive_id, link, user_id, ts, sha256, tg_unique_id, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id, tg_unique_id) DO NOTHING",
+                (name, drive_id, link, user_id, int(time.time()), sha256, tg_unique_id, size),
+            )
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        logger.error(f"Error saving to {UPLOADED_FILES_DB}: {e}")
+        return False
+
+def link_existing_upload(existing: dict, user_id: int, tg_unique_id: str):
+    """Records an already-uploaded Drive file for a user who sent it again (or sent a copy).
+
+    No-op if the user already has this Telegram file. The row has no size, since nothing
+    was transferred, so it doesn't count towards the daily quota.
+    """
+    try:
+        with _conn:
+            _conn.execute(
+                "INSERT OR IGNORE INTO uploads (name, drive_id, link, user_id, ts, sha256, tg_unique_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (existing["name"], existing["drive_id"], existing["link"], user_id, int(time.time()), existing["sha256"], tg_unique_id),
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Error saving to {UPLOADED_FILES_DB}: {e}")
+
+# --- Google Drive Upload ---
+# Dedicated pool for the blocking upload loops, so long uploads can't starve other
+# users of the loop's default executor (DNS lookups, token refreshes, service builds).
+_upload_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TRANSFERS, thread_name_prefix="drive-upload")
+
+def _do_upload(request, file_name: str):
+    """Runs an upload to completion. Blocking; call it from a worker thread."""
+    # httplib2 is not thread-safe, so each upload gets its own authorized Http
+    # instead of sharing the one inside the cached service.
+    # build_http() keeps googleapiclient's settings: a socket timeout, and 308 ("Resume
+    # Incomplete") not treated as a redirect, which resumable uploads depend on.
+    http = google_auth_httplib2.AuthorizedHttp(_drive_creds, http=build_http())
+    if not request.resumable:
+        # Small file: one multipart request, no session setup round-trip
+        return request.execute(http=http)
+
+    # Only log every PROGRESS_LOG_STEP percent to keep the logs readable; progress is not
+    # pushed to Telegram since frequent message edits get rate-limited.
+    response = None
+    last_logged = -PROGRESS_LOG_STEP
+    while response is None:
+        status, response = request.next_chunk(http=http)
+        if status:
+            progress = int(status.progress() * 100)
+            if progress - last_logged >= PROGRESS_LOG_STEP:
+                logger.info(f"Uploading '{file_name}': {progress}%")
+                last_logged = progress
+    return response
+
+async def upload_to_drive(stream, file_metadata: dict, mime_type: str, size: int, file_name: str):
+    """Uploads a readable binary stream to Google Drive and returns the created file's metadata.
+
+    Returns None if no Drive service is available. If the cached credentials are
+    rejected, the service is rebuilt and the upload is retried once.
+    """
+    for attempt in range(2):
+        drive_service = await get_drive_service_cached()
+        if not drive_service:
+            return None
+
+        stream.seek(0)
+        media = MediaIoBaseUpload(
+            stream,
+            mimetype=mime_type or "application/octet-stream", # Provide mimetype if known
+            chunksize=UPLOAD_CHUNK_SIZE,
+            resumable=size > SINGLE_REQUEST_UPLOAD_MAX # Good for larger files
+            )
+
+        # Make the API request
+        request = drive_service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields="id, name, webViewLink" # Request fields needed
+        )
+
+        try:
+            # next_chunk() blocks, so run the upload loop in a worker thread
+            return await asyncio.get_running_loop().run_in_executor(_upload_executor, _do_upload, request, file_name)
+        except RefreshError as e:
+            if attempt:
+                raise
+            logger.warning(f"Google credentials were rejected ({e}). Rebuilding Drive service and retrying.")
+            invalidate_drive_service()
+
+# --- Telegram Download ---
+def _redact_token(text: str) -> str:
+    """Masks the bot token, which is embedded in Bot API file URLs."""
+    return text.replace(TELEGRAM_BOT_TOKEN, "<bot-token>") if TELEGRAM_BOT_TOKEN else text
+
+# Shared across downloads so connections to the Bot API file server are kept alive and reused
+_http_session = None
+# Bounds concurrent download+upload work (and so spool memory); created in post_init
+_transfer_semaphore = None
+_in_flight = set()  # (user_id, file_unique_id) pairs currently being transferred
+
+async def _download_telegram_file(session: aiohttp.ClientSession, file_url: str, out) -> tuple:
+    """Streams a file from the Bot API file server into `out`. Returns (size, sha256 hex digest)."""
+    content_hash = hashlib.sha256() # Hashed while streaming, so duplicates cost no extra pass
+    async with session.get(file_url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            content_hash.update(chunk)
+            out.write(chunk)
+    return out.tell(), content_hash.hexdigest()
+
+def _hash_local_file(path: str) -> tuple:
+    """Hashes a file on disk. Returns (size, sha256 hex digest). Blocking; run it in a thread."""
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            content_hash.update(chunk)
+    return os.path.getsize(path), content_hash.hexdigest()
+
+def _remove_local_file(path: str):
+    """Deletes a file fetched by the local Bot API server; the server never cleans these up itself."""
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.error(f"Error removing local Bot API file '{path}': {e}")
 
 # --- Telegram Bot Handlers ---
 
@@ -159,60 +497,76 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         f"/myfiles - List files you've uploaded via this bot\n\n"
         f"**File Size Limit:** {MAX_FILE_SIZE_MB} MB per file."
     )
+    if DAILY_QUOTA_MB:
+        help_text += f"\n**Daily Quota:** {DAILY_QUOTA_MB} MB per user every 24 hours."
     await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
 
-async def myfiles_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Lists the files uploaded by the user (stored in the bot's simple DB)."""
-    user_id = update.effective_user.id
-    uploaded_files = load_uploaded_files()
-
-    # In this simple version, we list all files. For per-user tracking,
-    # the data structure in uploaded_files.json would need to change.
-    # e.g., { "user_id": [ {file_info}, ... ], ... }
-    # For now, let's assume it's a personal bot or lists all files globally.
+def _render_files_page(user_id: int, page: int):
+    """Builds the text and navigation keyboard for one page of a user's files (page 0 = newest).
 
+    Returns (None, None) if the page is empty.
+    """
+    offset = page * FILES_PAGE_SIZE
+    # Fetch one extra row to find out whether there is a next page.
+    uploaded_files = list_recent(limit=FILES_PAGE_SIZE + 1, user_id=user_id, offset=offset)
+    has_next = len(uploaded_files) > FILES_PAGE_SIZE
+    uploaded_files = uploaded_files[:FILES_PAGE_SIZE]
     if not uploaded_files:
-        await update.message.reply_text("You haven't uploaded any files yet using this bot.")
-        return
-
-    message_text = "📂 **Your Uploaded Files:**\n\n"
-    file_count = 0
-    # Let's only show the latest N files to avoid super long messages
-    max_files_to_show = 25
-    start_index = max(0, len(uploaded_files) - max_files_to_show)
+        return None, None
 
-    for i, file_info in enumerate(uploaded_files[start_index:], start=start_index + 1):
-        file_name = file_info.get("name", "Unknown File")
-        file_link = file_info.get("link", None)
+    # HTML escaping can't produce invalid markup, so the message always renders
+    parts = ["📂 <b>Your Uploaded Files:</b>\n\n"]
+    for i, file_info in enumerate(uploaded_files, start=offset + 1):
+        file_name = html.escape(file_info.get("name") or "Unknown File")
+        file_link = file_info.get("link")
         if file_link:
-            # Escape markdown characters in filename
-            escaped_name = file_name.replace('_', r'\_').replace('*', r'\*').replace('[', r'\[').replace('`', r'\`')
-            message_text += f"{i}. [{escaped_name}]({file_link})\n"
-            file_count += 1
+            parts.append(f'{i}. <a href="{html.escape(file_link, quote=True)}">{file_name}</a>\n')
         else:
             # Handle files stored before link was saved (or if save failed)
-             message_text += f"{i}. {file_name} (Link unavailable)\n"
-             file_count += 1
+             parts.append(f"{i}. {file_name} (Link unavailable)\n")
+    parts.append(f"\n<i>Page {page + 1}</i>")
 
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀ Prev", callback_data=f"myfiles:{user_id}:page:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data=f"myfiles:{user_id}:page:{page + 1}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "".join(parts), reply_markup
+
+async def myfiles_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Lists the files uploaded by the user (stored in the bot's simple DB), one page at a time."""
+    message_text, reply_markup = _render_files_page(update.effective_user.id, 0)
+    if message_text is None:
+        await update.message.reply_text("You haven't uploaded any files yet using this bot.")
+        return
 
-    if file_count == 0 :
-         await update.message.reply_text("Couldn't find any files with links.")
-         return
+    await update.message.reply_text(
+        message_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup, disable_web_page_preview=True
+    )
 
-    if len(uploaded_files) > max_files_to_show:
-         message_text += f"\n_Showing the latest {max_files_to_show} files._"
+async def myfiles_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Switches the /myfiles message to another page when a navigation button is pressed."""
+    query = update.callback_query
+    _, owner_id, _, page = query.data.split(":")
+    # The buttons carry the list owner's ID, so others (e.g. in a group) can't swap in their own list
+    if int(owner_id) != query.from_user.id:
+        await query.answer("These buttons belong to someone else's /myfiles. Send /myfiles to see your own files.", show_alert=True)
+        return
+    await query.answer()
+    page = int(page)
 
+    message_text, reply_markup = _render_files_page(query.from_user.id, page)
+    if message_text is None:
+        message_text = "No more files to show."
     try:
-        await update.message.reply_text(message_text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-    except Exception as e:
-        logger.error(f"Error sending file list: {e}")
-        # Fallback to plain text if markdown fails
-        plain_text = "Your Uploaded Files:\n\n"
-        for i, file_info in enumerate(uploaded_files[start_index:], start=start_index+1):
-             plain_text += f"{i}. {file_info.get('name', 'Unknown File')} - Link: {file_info.get('link', 'N/A')}\n"
-        if len(uploaded_files) > max_files_to_show:
-            plain_text += f"\nShowing the latest {max_files_to_show} files."
-        await update.message.reply_text(plain_text, disable_web_page_preview=True)
+        await query.edit_message_text(
+            message_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup, disable_web_page_preview=True
+        )
+    except BadRequest as e:
+        # Double taps and stale buttons re-render the same page; Telegram rejects no-op edits
+        if "message is not modified" not in str(e).lower():
+            raise
 
 
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -254,6 +608,20 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     file_id = file_to_upload.file_id
     file_size = file_to_upload.file_size
 
+    # Telegram's file_unique_id is stable across forwards, so a hit means no download or upload at all
+    existing = find_upload_by_tg_unique_id(file_to_upload.file_unique_id)
+    if existing:
+        logger.info(f"File '{file_name}' was already uploaded as '{existing['name']}'. Skipping.")
+        link_existing_upload(existing, user.id, file_to_upload.file_unique_id)
+        await update.message.reply_text(
+            f"✅ **Already Uploaded!**\n\n"
+            f"📄 File: `{existing['name']}`\n"
+            f"🔗 Link: {existing['link']}",
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=False
+        )
+        return
+
     # 1. Check file size limit
     if file_size > MAX_FILE_SIZE_BYTES:
         logger.info(f"User {user.id} tried to upload file '{file_name}' ({file_size / 1024 / 1024:.2f} MB) - Exceeds limit.")
@@ -265,110 +633,154 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         )
         return
 
-    # 2. Get Google Drive Service (checks auth)
-    drive_service = get_drive_service()
-    if not drive_service:
-        logger.error("Failed to get Google Drive service. Upload aborted.")
-        await update.message.reply_text(
-            "⚠️ Could not connect to Google Drive. Authentication might be needed or configuration is wrong. Please check the bot logs or contact the administrator."
+    # Check the per-user quota over the last 24 hours (indexed by user, so this stays cheap)
+    if DAILY_QUOTA_BYTES:
+        used_bytes = bytes_uploaded_since(user.id, int(time.time()) - 24 * 60 * 60)
+        if used_bytes + file_size > DAILY_QUOTA_BYTES:
+            logger.info(f"User {user.id} tried to upload file '{file_name}' - Daily quota exceeded ({used_bytes / 1024 / 1024:.2f} MB used).")
+            await update.message.reply_text(
+                f"❌ **Daily Quota Reached!**\n\n"
+                f"You have uploaded {used_bytes / 1024 / 1024:.2f} MB in the last 24 hours. "
+                f"The limit is {DAILY_QUOTA_MB} MB per day.",
+                parse_mode=ParseMode.MARKDOWN
             )
-        return # Stop processing if Drive service fails
-
-    # 3. Download the file from Telegram
-    download_path = Path(f"./temp_{file_id}") # Store temporarily
-    try:
-        status_message = await update.message.reply_text(f" SDownloading '{file_name}' from Telegram...")
-        tg_file = await context.bot.get_file(file_id)
-        await tg_file.download_to_drive(download_path)
-        logger.info(f"File '{file_name}' downloaded to '{download_path}'")
+            return
 
-    except Exception as e:
-        logger.error(f"Failed to download file {file_id} from Telegram: {e}")
-        await status_message.edit_text(f"❌ Error downloading file from Telegram: {e}")
-        return # Stop if download fails
+    # Two quick sends of the same file would both miss the lookups above and upload twice
+    in_flight_key = (user.id, file_to_upload.file_unique_id)
+    if in_flight_key in _in_flight:
+        await update.message.reply_text(f"⏳ '{file_name}' is already being uploaded. You'll get the link when it's done.")
+        return
+    _in_flight.add(in_flight_key)
 
-    # 4. Upload the file to Google Drive
     try:
-        await status_message.edit_text(f"⏳ Uploading '{file_name}' to Google Drive...")
-
-        file_metadata = {
-            "name": file_name,
-        }
-        # Add to specific folder if ID is provided
-        if GOOGLE_DRIVE_FOLDER_ID:
-             file_metadata["parents"] = [GOOGLE_DRIVE_FOLDER_ID]
-
-        media = MediaFileUpload(
-            download_path,
-            mimetype=mime_type, # Provide mimetype if known
-            resumable=True # Good for larger files
-            )
-
-        # Make the API request
-        request = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields="id, name, webViewLink" # Request fields needed
-        )
-
-        gdrive_file = None
-        response = None
-        while response is None:
-            status, response = request.next_chunk()
-            if status:
-                 progress = int(status.progress() * 100)
-                 logger.info(f"Uploading '{file_name}': {progress}%")
-                 # Avoid flooding Telegram with progress updates, update maybe every 20%
-                 # Or just show the initial 'uploading' message
-                 # await status_message.edit_text(f"⏳ Uploading '{file_name}' to Google Drive... {progress}%")
-
-
-        gdrive_file = response # response contains the file metadata upon completion
-
-        if gdrive_file and gdrive_file.get("id"):
-            file_id_drive = gdrive_file.get("id")
-            file_link_drive = gdrive_file.get("webViewLink")
-            uploaded_file_name = gdrive_file.get("name")
-            logger.info(f"File '{uploaded_file_name}' uploaded successfully. ID: {file_id_drive}, Link: {file_link_drive}")
-
-            # 5. Store file info in our simple DB
-            uploaded_files_list = load_uploaded_files()
-            uploaded_files_list.append({
-                "name": uploaded_file_name,
-                "id": file_id_drive,
-                "link": file_link_drive,
-                "telegram_user_id": user.id # Optional: store who uploaded
-            })
-            save_uploaded_files(uploaded_files_list)
-
-            # 6. Send confirmation and link to user
-            await status_message.edit_text(
-                f"✅ **Upload Successful!**\n\n"
-                f"📄 File: `{uploaded_file_name}`\n"
-                f"🔗 Link: {file_link_drive}",
-                parse_mode=ParseMode.MARKDOWN,
-                disable_web_page_preview=False # Show preview for the Drive link
-            )
-        else:
-             logger.error(f"Google Drive API did not return expected file info after upload for '{file_name}'. Response: {gdrive_file}")
-             await status_message.edit_text(f"❌ Upload completed but failed to get file details from Google Drive.")
-
-    except HttpError as error:
-        logger.error(f"An API error occurred during upload: {error}")
-        await status_message.edit_text(f"❌ Google Drive API Error: {error}")
-    except Exception as e:
-        logger.error(f"An unexpected error occurred during upload: {e}")
-        await status_message.edit_text(f"❌ An unexpected error occurred during upload: {e}")
+        # 2. Get the file from Telegram. Over HTTP it is streamed into a spooled buffer: small
+        #    files stay in memory, larger ones spill into the OS temp dir. With a local Bot API
+        #    server the file is already on disk and is uploaded straight from there.
+        #    Leaving the block closes (and, in local mode, deletes) the file.
+        #    The semaphore limits how many files are in flight at once.
+        status_message = await update.message.reply_text(f" SDownloading '{file_name}' from Telegram...")
+        async with _transfer_semaphore:
+            with contextlib.ExitStack() as stack:
+                try:
+                    tg_file = await context.bot.get_file(file_id)
+                    if TELEGRAM_LOCAL_API_URL and os.path.isfile(tg_file.file_path):
+                        stack.callback(_remove_local_file, tg_file.file_path)
+                        downloaded_size, sha256 = await asyncio.to_thread(_hash_local_file, tg_file.file_path)
+                        stream = stack.enter_context(open(tg_file.file_path, "rb"))
+                    else:
+                        stream = stack.enter_context(
+                            tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=tempfile.gettempdir())
+                        )
+                        downloaded_size, sha256 = await _download_telegram_file(_http_session, tg_file.file_path, stream)
+                    logger.info(f"File '{file_name}' downloaded ({downloaded_size} bytes)")
+
+                # The download URL contains the bot token, so never echo raw download errors
+                except aiohttp.ClientResponseError as e:
+                    logger.error(f"Failed to download file {file_id} from Telegram: HTTP {e.status}")
+                    await status_message.edit_text(f"❌ Error downloading file from Telegram (HTTP {e.status}).")
+                    return # Stop if download fails
+                except Exception as e:
+                    logger.error(f"Failed to download file {file_id} from Telegram: {_redact_token(str(e))}")
+                    await status_message.edit_text("❌ Error downloading file from Telegram.")
+                    return # Stop if download fails
+
+                # Skip the upload entirely if identical content is already in Drive
+                existing = find_upload_by_sha256(sha256)
+                if existing:
+                    logger.info(f"File '{file_name}' matches already uploaded '{existing['name']}' (sha256 {sha256}). Skipping upload.")
+                    # Also remembers this file_unique_id, so the next forward skips the download too
+                    link_existing_upload(existing, user.id, file_to_upload.file_unique_id)
+                    await status_message.edit_text(
+                        f"✅ **Already Uploaded!**\n\n"
+                        f"📄 File: `{existing['name']}`\n"
+                        f"🔗 Link: {existing['link']}",
+                        parse_mode=ParseMode.MARKDOWN,
+                        disable_web_page_preview=False
+                    )
+                    return
+
+                # 3. Upload the file to Google Drive
+                try:
+                    await status_message.edit_text(f"⏳ Uploading '{file_name}' to Google Drive...")
+
+                    file_metadata = {
+                        "name": file_name,
+                    }
+                    # Add to specific folder if ID is provided
+                    if GOOGLE_DRIVE_FOLDER_ID:
+                         file_metadata["parents"] = [GOOGLE_DRIVE_FOLDER_ID]
+
+                    gdrive_file = await upload_to_drive(stream, file_metadata, mime_type, downloaded_size, file_name)
+                    if gdrive_file is None:
+                        logger.error("Failed to get Google Drive service. Upload aborted.")
+                        await status_message.edit_text(
+                            "⚠️ Could not connect to Google Drive. Authentication might be needed or configuration is wrong. Please check the bot logs or contact the administrator."
+                            )
+                        return # Stop processing if Drive service fails
+
+                    if gdrive_file and gdrive_file.get("id"):
+                        file_id_drive = gdrive_file.get("id")
+                        file_link_drive = gdrive_file.get("webViewLink")
+                        uploaded_file_name = gdrive_file.get("name")
+                        logger.info(f"File '{uploaded_file_name}' uploaded successfully. ID: {file_id_drive}, Link: {file_link_drive}")
+
+                        # 4. Store file info in our simple DB
+                        if not add_upload(
+                            uploaded_file_name, file_id_drive, file_link_drive, user.id,
+                            sha256=sha256, tg_unique_id=file_to_upload.file_unique_id, size=downloaded_size,
+                        ):
+                            # Another message from this user recorded the file first; reply with the recorded link
+                            existing = find_upload_by_tg_unique_id(file_to_upload.file_unique_id, user_id=user.id)
+                            if existing:
+                                logger.warning(f"'{file_name}' was already recorded for user {user.id}; Drive copy {file_id_drive} is not tracked.")
+                                uploaded_file_name, file_link_drive = existing['name'], existing['link']
+
+                        # 5. Send confirmation and link to user
+                        await status_message.edit_text(
+                            f"✅ **Upload Successful!**\n\n"
+                            f"📄 File: `{uploaded_file_name}`\n"
+                            f"🔗 Link: {file_link_drive}",
+                            parse_mode=ParseMode.MARKDOWN,
+                            disable_web_page_preview=False # Show preview for the Drive link
+                        )
+                    else:
+                         logger.error(f"Google Drive API did not return expected file info after upload for '{file_name}'. Response: {gdrive_file}")
+                         await status_message.edit_text(f"❌ Upload completed but failed to get file details from Google Drive.")
+
+                except HttpError as error:
+                    logger.error(f"An API error occurred during upload: {error}")
+                    await status_message.edit_text(f"❌ Google Drive API Error: {error}")
+                except Exception as e:
+                    logger.error(f"An unexpected error occurred during upload: {e}")
+                    await status_message.edit_text(f"❌ An unexpected error occurred during upload: {e}")
     finally:
-        # 7. Clean up the downloaded file
-        if download_path.exists():
-            try:
-                os.remove(download_path)
-                logger.info(f"Temporary file '{download_path}' removed.")
-            except OSError as e:
-                logger.error(f"Error removing temporary file '{download_path}': {e}")
+        _in_flight.discard(in_flight_key)
 
 # --- Main Bot Execution ---
+_warmup_task = None  # Background Drive service warm-up started in post_init
+
+async def post_init(application: Application) -> None:
+    """Runs once the event loop is up, before polling starts."""
+    global _http_session, _transfer_semaphore, _drive_service_lock
+    # Created here rather than at import time: on Python < 3.10 asyncio primitives bind to
+    # the loop current at creation, and uvloop.install() in main() swaps the loop policy.
+    _transfer_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
+    _drive_service_lock = asyncio.Lock()
+    _http_session = aiohttp.ClientSession()
+
+    # Warm up the Drive service while the bot is already polling (no-op if main() built it).
+    # Application.create_task would warn here because the application isn't running yet;
+    # keep a reference so the task isn't garbage collected mid-flight.
+    global _warmup_task
+    _warmup_task = asyncio.create_task(get_drive_service_cached())
+
+async def post_shutdown(application: Application) -> None:
+    """Releases resources opened in post_init."""
+    if _http_session:
+        await _http_session.close()
+    _upload_executor.shutdown(wait=False)
+
 def main() -> None:
     """Start the bot."""
     # Basic check for token
@@ -377,33 +789,64 @@ def main() -> None:
         print("\nERROR: TELEGRAM_BOT_TOKEN is missing. Set it in the .env file or environment variables.\n")
         return
 
-    # First, try to authenticate with Google Drive on startup
-    # This will trigger the browser flow if token.json is missing/invalid
-    print("Attempting initial Google Drive authentication...")
-    drive_service = get_drive_service()
-    if not drive_service:
-        logger.critical("Failed initial Google Drive authentication. Check logs and configuration. Bot will start but uploads will fail.")
-        print("\nWarning: Could not authenticate with Google Drive. Uploads will fail until authenticated.\n")
-        # Decide if you want the bot to exit or continue running without upload functionality
-        # return # Uncomment this line to stop the bot if auth fails initially
+    # Only authenticate up front when there is no token yet: this triggers the browser flow.
+    # With an existing token.json the Drive service is built in the background (see post_init).
+    if not os.path.exists(TOKEN_FILE):
+        print("Attempting initial Google Drive authentication...")
+        drive_service = get_drive_service()
+        if not drive_service:
+            logger.critical("Failed initial Google Drive authentication. Check logs and configuration. Bot will start but uploads will fail.")
+            print("\nWarning: Could not authenticate with Google Drive. Uploads will fail until authenticated.\n")
+            # Decide if you want the bot to exit or continue running without upload functionality
+            # return # Uncomment this line to stop the bot if auth fails initially
 
+        else:
+            print("Google Drive authentication successful.")
     else:
-        print("Google Drive authentication successful or token loaded.")
+        print("Found existing Google Drive token. Drive service will be set up in the background.")
 
 
+    # Use the libuv-based event loop when available (optional, not supported on Windows)
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            uvloop.install()
+            logger.info("Using uvloop event loop.")
+        except ImportError:
+            pass
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # concurrent_updates lets one user's upload proceed while others are being handled
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_LOCAL_API_URL:
+        print(f"Using local Bot API server at {TELEGRAM_LOCAL_API_URL}")
+        builder = (
+            builder.base_url(f"{TELEGRAM_LOCAL_API_URL}/bot")
+            .base_file_url(f"{TELEGRAM_LOCAL_API_URL}/file/bot")
+            .local_mode(True)
+        )
+    application = builder.build()
+
+    # Keep the Google token fresh in the background so uploads don't pay for refreshes
+    if application.job_queue:
+        application.job_queue.run_repeating(_refresh_job, interval=60, first=60)
+    else:
+        logger.warning("JobQueue is not available (install python-telegram-bot[job-queue]). Tokens will be refreshed inline.")
 
     # --- Register Handlers ---
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("myfiles", myfiles_command))
+    application.add_handler(CallbackQueryHandler(myfiles_page_callback, pattern=r"^myfiles:\d+:page:\d+$"))
 
-    # Add handlers for different file types
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_file))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_file))
-    application.add_handler(MessageHandler(filters.VIDEO, handle_file))
-    application.add_handler(MessageHandler(filters.AUDIO, handle_file))
+    # One handler for all supported file types (documents first, they're the most common)
+    application.add_handler(MessageHandler(filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO, handle_file))
     # You can add more filters (e.g., filters.VOICE) if needed
 
     # --- Start the Bot ---